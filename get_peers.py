@@ -1,15 +1,31 @@
-import os
+import asyncio
+import io
+import posixpath
 import re
-import shutil
-import tempfile
 import zipfile
-from typing import List, Optional
+from typing import IO, Iterator, List, Optional
 import logging as log
 log.basicConfig(level=log.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s')
-import requests
+import httpx
+
+# Compiled once at import time.
+# socks peers for tor and i2p share the pattern with plain peers: the part after
+# the proxy is captured as `tail` and split with plain string operations.
+_PEER_RE = re.compile(
+    rb"(?P<proto>tcp|tls|quic|ws|wss|socks)://(?P<addr>[a-z0-9\.\-:\[\]]+):(?P<port>[0-9]+)"
+    rb"(?:\?key=(?P<key>[0-9a-f]*)|(?P<tail>/[/0-9a-z\.:]+))?"
+)
+_HIDDEN_NETWORKS = ('onion', 'b32.i2p')
+_MAX_PORT = 65535
+_SCAN_CHUNK = 1 << 16
+_SCAN_OVERLAP = 256 # longer than any peer uri
 
 
 class Peer():
+    __slots__ = ('proto', 'addr', 'port', 'region', 'country', 'is_alive',
+                 'latency', 'ping_latency', 'key', 'network', 'proxy',
+                 'host', 'port_num', '_uri_nokey', '_uri_key')
+
     def __init__(self, proto, 
                  addr, port, 
                  region, country, 
@@ -28,16 +44,17 @@ class Peer():
         self.key = key
         self.network = network # values: 'internet', 'onion' for tor, 'b32.i2p' for i2p
         self.proxy = proxy
+        self.host = addr[1:-1] if addr.startswith('[') else addr # addr without ipv6 brackets
+        self.port_num = int(port)
+        # the uri only depends on fields that do not change after construction
+        if network == 'internet':
+            self._uri_nokey = ''.join((proto, "://", addr, ":", port))
+            self._uri_key = ''.join((self._uri_nokey, "?key=", key)) if key else self._uri_nokey
+        else:
+            self._uri_nokey = self._uri_key = ''.join(("socks://", proxy, "/", addr, ".", network, ":", port))
     
     def get_uri(self, key=False) -> str:
-        if self.network == 'internet':
-            uri = self.proto+"://"+self.addr+":"+self.port
-            if key and self.key != '':
-                return uri+"?key="+self.key
-            else:
-                return uri
-        else:
-            return f"socks://{self.proxy}/{self.addr}.{self.network}:{self.port}"
+        return self._uri_key if key else self._uri_nokey
     
     def __str__(self):
         return self.get_uri(key=True)
@@ -46,7 +63,61 @@ class Peer():
         return (self.get_uri(key=False), self.region, self.country, self.latency, self.ping_latency)
     
 
-def process_zip_from_url(
+def _peer_from_match(match: re.Match, region: str, country: str) -> Optional[Peer]:
+    """
+    Builds a Peer from a _PEER_RE match, or None for a socks uri that does not
+    point to a tor or i2p hidden service or for an out of range port.
+    """
+    proto, addr, port = (g.decode('ascii') for g in match.group('proto', 'addr', 'port'))
+    if int(port) > _MAX_PORT:
+        return None
+    if proto != 'socks':
+        return Peer(proto, addr, port, region, country,
+                    key=(match.group('key') or b'').decode('ascii'),
+                    network='internet'
+        )
+    # tail is '/<addr>.<network>[:<port>]', e.g. '/abcd.onion:1234' or '/abcd.b32.i2p'
+    tail = (match.group('tail') or b'').decode('ascii')
+    target, _, hidden_port = tail.lstrip('/').partition(':')
+    hidden_addr, _, network = target.partition('.')
+    if network not in _HIDDEN_NETWORKS or not hidden_addr:
+        return None
+    if hidden_port and (not hidden_port.isdigit() or int(hidden_port) > _MAX_PORT):
+        return None
+    return Peer('tcp',
+                hidden_addr,
+                hidden_port or '0',
+                'hidden',
+                'unknown',
+                network=network,
+                proxy=addr+':'+port
+    )
+
+
+def _iter_peer_matches(entry: IO[bytes]) -> Iterator[re.Match]:
+    """
+    Yields the _PEER_RE matches of a zip member while it is being decompressed.
+    The tail of each chunk is carried over to the next one, so a uri cut
+    between two chunks is matched once, as a whole. Chunks without any
+    '://' never reach the regex.
+    """
+    buf = b''
+    while chunk := entry.read(_SCAN_CHUNK):
+        buf += chunk
+        limit = len(buf) - _SCAN_OVERLAP
+        end = 0
+        if b"://" in buf: # plain substring search is much cheaper than the regex
+            for match in _PEER_RE.finditer(buf):
+                if match.start() >= limit: # may still be incomplete
+                    break
+                end = match.end()
+                yield match
+        buf = buf[max(limit, end, 0):]
+    if b"://" in buf:
+        yield from _PEER_RE.finditer(buf)
+
+
+async def process_zip_from_url(
     zip_url: str,
     files_to_remove: Optional[List[str]] = None,
     dirs_to_remove: Optional[List[str]] = None,
@@ -56,135 +127,66 @@ def process_zip_from_url(
 
     Args:
         zip_url: The URL of the .zip file to download.
-        regex_pattern: The raw regex string to match against lines in files.
-        files_to_remove: A list of relative paths to files to remove after extraction.
-        dirs_to_remove: A list of relative paths to directories to remove after extraction.
+        files_to_remove: A list of paths inside the archive of files to skip.
+        dirs_to_remove: A list of paths inside the archive of directories to skip.
 
     Returns:
-        A list of all lines from all files that matched the regex pattern.
+        A list of all peers found in the files of the archive.
         
     Raises:
-        requests.exceptions.RequestException: If the download fails.
+        httpx.HTTPError: If the download fails.
         zipfile.BadZipFile: If the downloaded file is not a valid zip file.
     """
     # Use lists for iteration, handling the optional None case
     files_to_remove = files_to_remove or []
-    dirs_to_remove = dirs_to_remove or []
-    peer_list: List[Tuple(str,str,str)] = []
-
-    # Compile the regex for efficiency in the loop
-    regex_pattern = r"(tcp|tls|quic|ws|wss|socks)://([a-z0-9\.\-:\[\]]+):([0-9]+)[\?key=]*([0-9a-f]*)"
-    compiled_regex = re.compile(regex_pattern)
-    # to capture tor and i2p
-    regex2 = r"(socks)://([a-z0-9\.\-:\[\]]+):([0-9]+)[/]+([0-9a-z]+)\.(onion|b32.i2p):*([0-9]*)"
-    compiled_regex_hidden = re.compile(regex2)
-    
-    # Create a secure temporary directory that will be automatically cleaned up
-    with tempfile.TemporaryDirectory() as temp_dir:
-        zip_path = os.path.join(temp_dir, 'downloaded_file.zip')
-        extract_path = os.path.join(temp_dir, 'extracted_data')
-        os.makedirs(extract_path)
-
-        # 1. Download the file from the URL
-        log.info(f"⬇️  Downloading from {zip_url}...")
-        with requests.get(zip_url, stream=True) as response:
+    dirs_to_remove = tuple(d.rstrip('/') + '/' for d in dirs_to_remove or [])
+    peer_list: List[Peer] = []
+
+    # 1. Download the file from the URL, the archive is kept in memory
+    log.info(f"⬇️  Downloading from {zip_url}...")
+    buf = io.BytesIO()
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        async with client.stream('GET', zip_url) as response:
             response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-            with open(zip_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        log.debug("✅ Download complete.")
-
-        # 2. Extract the ZIP file
-        log.debug(f"📦 Unzipping file to temporary location...")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_path)
-        log.debug("✅ Extraction complete.")
-
-        # 3. Remove specified files and directories
-        log.debug("🗑️  Cleaning up specified files and directories...")
-        # Remove files
-        for file_path in files_to_remove:
-            full_path = os.path.join(extract_path, file_path)
+            async for chunk in response.aiter_bytes(1 << 16):
+                buf.write(chunk)
+    buf.seek(0)
+    log.debug("✅ Download complete.")
+
+    # 2. Read every member straight from the archive, skipping the unwanted ones
+    log.debug("🔍 Searching for regex matches...")
+    with zipfile.ZipFile(buf, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            if info.filename in files_to_remove or info.filename.startswith(dirs_to_remove):
+                log.debug(f"  - Skipped: {info.filename}")
+                continue
+            root, filename = posixpath.split(info.filename)
+            region = posixpath.basename(root)
+            country = filename[:-3]
             try:
-                os.remove(full_path)
-                log.debug(f"  - Removed file: {full_path}")
-            except FileNotFoundError:
-                log.debug(f"  - Warning: File not found, skipping: {full_path}")
+                # Scan while decompressing, the regex does not depend on line breaks
+                with zip_ref.open(info) as entry:
+                    for match in _iter_peer_matches(entry):
+                        p = _peer_from_match(match, region, country)
+                        if p is not None:
+                            peer_list.append(p)
             except Exception as e:
-                log.debug(f"  - Error removing file {full_path}: {e}")
+                log.debug(f"  - Could not read file {info.filename}: {e}")
 
-        # Remove directories
-        for dir_path in dirs_to_remove:
-            full_path = os.path.join(extract_path, dir_path)
-            try:
-                shutil.rmtree(full_path)
-                log.debug(f"  - Removed directory: {full_path}")
-            except FileNotFoundError:
-                log.debug(f"  - Warning: Directory not found, skipping: {full_path}")
-            except Exception as e:
-                log.debug(f"  - Error removing directory {full_path}: {e}")
-        log.debug("✅ Cleanup complete.")
-        
-        # 4. Iterate through all files, read lines, and check against regex
-        log.debug("🔍 Searching for regex matches...")
-        for root, _, files in os.walk(extract_path):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                try:
-                    # Open file with robust encoding handling
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        for line in f:
-                            matches_in_line = compiled_regex.findall(line)
-                            if not matches_in_line:
-                                continue
-                            
-                            for match in matches_in_line:
-                                # `match` is a string if 1 group, a tuple if multiple groups
-                                if isinstance(match, tuple):
-                                    # Add all non-empty captured groups from the tuple
-                                    if match[0] != 'socks':
-                                        p = Peer(match[0], # proto
-                                                 match[1], # addr
-                                                 match[2], # port
-                                                 os.path.basename(root), # region
-                                                 filename[:-3], # country
-                                                 key=match[3],
-                                                 network='internet' 
-                                       )
-                                    else:
-                                        matches_hidden = compiled_regex_hidden.findall(line)
-                                        for mh in matches_hidden:
-                                            if isinstance(mh, tuple):
-                                                p = Peer('tcp',
-                                                         mh[3], # addr
-                                                         mh[5] if mh[5] != '' else '0', # port
-                                                         'hidden',
-                                                         'unknown',
-                                                         network=mh[4],
-                                                         proxy=mh[1]+':'+mh[2]
-                                                )
-                                            else:
-                                                raise ValueError(f"Malformed peer line address: '{match}'")
-                                        
-                                    peer_list.append(p)
-                                else:
-                                    raise ValueError(f"Malformed peer line address: '{match}'")
-                except Exception as e:
-                    log.debug(f"  - Could not read file {file_path}: {e}")
-        
-        log.debug(f"✅ Search complete. Found {len(peer_list)} matches.")
-    # The temporary directory and its contents are automatically removed here
+    log.debug(f"✅ Search complete. Found {len(peer_list)} matches.")
     return peer_list
 
 
-def get_peers():
+async def get_peers():
     TARGET_URL = "https://github.com/yggdrasil-network/public-peers/archive/refs/heads/master.zip"
 
     FILES_TO_DELETE = ["public-peers-master/README.md", "peers.zip"]
     DIRS_TO_DELETE = ["public-peers-master/.github"]
 
     try:
-        results = process_zip_from_url(
+        results = await process_zip_from_url(
             zip_url=TARGET_URL,
             files_to_remove=FILES_TO_DELETE,
             dirs_to_remove=DIRS_TO_DELETE,
@@ -199,6 +201,6 @@ def get_peers():
     return None
 
 if __name__ == "__main__":
-    for peer in get_peers():
+    for peer in asyncio.run(get_peers()):
         print(peer)
 
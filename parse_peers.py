@@ -1,6 +1,9 @@
 import asyncio
+import copy
 import socket
 import ssl
+import time
+from operator import attrgetter
 from typing import List, Tuple, Optional
 from get_peers import get_peers, Peer
 import logging as log
@@ -8,28 +11,41 @@ log.basicConfig(level=log.CRITICAL, format='%(asctime)s - %(levelname)s - %(mess
 import websockets
 from aioquic.asyncio import connect as aioquic_connect
 from aioquic.quic.configuration import QuicConfiguration
-from icmplib import async_ping
+from icmplib import async_multiping
 from tabulate import tabulate
 import socks
 
 
-def _test_tcp_sync(host: str, port: int, timeout: int = 5) -> Tuple[bool, str]:
-    """Tests a raw TCP connection using blocking sockets."""
+# Peers use self signed certificates, only the handshake matters
+_TLS_CONTEXT = ssl.create_default_context()
+_TLS_CONTEXT.check_hostname = False
+_TLS_CONTEXT.verify_mode = ssl.CERT_NONE
+# Delay before racing the next resolved address (happy eyeballs, RFC 8305),
+# so a dead IPv6 route does not cost a full timeout before IPv4 is tried
+_HAPPY_EYEBALLS_DELAY = 0.25
+_QUIC_CONFIG = QuicConfiguration(is_client=True, verify_mode=False, idle_timeout=2.0)
+
+
+async def _test_tcp(host: str, port: int, timeout: int = 5) -> Tuple[bool, str]:
+    """Tests a raw TCP connection."""
     try:
-        with socket.create_connection((host, port), timeout=timeout):
-            return True, f"Successfully connected to {host}:{port} via TCP."
+        _, writer = await asyncio.wait_for(asyncio.open_connection(
+            host, port, happy_eyeballs_delay=_HAPPY_EYEBALLS_DELAY), timeout)
+        writer.close()
+        return True, f"Successfully connected to {host}:{port} via TCP."
     except Exception as e:
         return False, f"Failed TCP connection to {host}:{port}: {e}"
 
-def _test_tls_sync(host: str, port: int, timeout: int = 5) -> Tuple[bool, str]:
+async def _test_tls(host: str, port: int, timeout: int = 5) -> Tuple[bool, str]:
     """Tests a TLS-wrapped TCP connection."""
     try:
-        sock = socket.create_connection((host, port), timeout=timeout)
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        with context.wrap_socket(sock, server_hostname=host) as ssock:
-            return True, f"Successfully connected to {host}:{port} via TLS. Version: {ssock.version()}"
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=_TLS_CONTEXT, server_hostname=host,
+                                    happy_eyeballs_delay=_HAPPY_EYEBALLS_DELAY), timeout
+        )
+        version = writer.get_extra_info('ssl_object').version()
+        writer.close()
+        return True, f"Successfully connected to {host}:{port} via TLS. Version: {version}"
     except Exception as e:
         return False, f"Failed TLS connection to {host}:{port}: {e}"
 
@@ -37,75 +53,85 @@ async def _test_websocket_async(uri: str, timeout: int = 5) -> Tuple[bool, str]:
     """Tests a WebSocket (ws://) or Secure WebSocket (wss://) connection."""
     proto = uri.split(":", 1)[0].upper()
     try:
-        async with websockets.connect(uri, open_timeout=timeout, family=socket.AF_INET6):
+        # extra arguments go to loop.create_connection, which races IPv6 and IPv4
+        async with websockets.connect(uri, open_timeout=timeout,
+                                      happy_eyeballs_delay=_HAPPY_EYEBALLS_DELAY):
             return True, f"Successfully connected to {uri} via {proto}."
     except Exception as e:
-        try:
-            async with websockets.connect(uri, open_timeout=timeout, family=socket.AF_INET):
-                return True, f"Successfully connected to {uri} via {proto}."
-        except Exception as e:
-            return False, f"Failed {proto} connection to {uri}: {e}"
+        return False, f"Failed {proto} connection to {uri}: {e}"
 
 
 async def _test_quic_async(host: str, port: int, timeout: int = 5) -> Tuple[bool, str]:
     """Tests a QUIC connection."""
-    config = QuicConfiguration(is_client=True, verify_mode=False, idle_timeout=2.0)
+    # aioquic.connect sets server_name on the configuration, so each peer gets its own copy
+    config = copy.copy(_QUIC_CONFIG)
     try:
         async with aioquic_connect(host, port, configuration=config):
             return True, f"Successfully established QUIC connection to {host}:{port}."
     except Exception as e:
         return False, f"Failed QUIC connection to {host}:{port}: {e}"
 
+async def _test_unsupported(peer: Peer, timeout: int = 5) -> Tuple[bool, str]:
+    """Fallback for protocols without a test, always fails."""
+    return False, f"Unsupported protocol: '{peer.proto}'."
 
-async def _ping(peer: Peer, timeout: int = 10) -> Peer:
-    """
-    Pings a single peer and prints the result. This is the core task
-    that will be run in parallel for each peer.
-    """
-    if peer.network != 'internet':
-        peer.ping_latency = 60000 # in case of tor or i2p
-        return peer
-    host = peer.addr
-    if host[0] == '[': # unpack ipv6
-        host = host[1:-1]
+# proto -> test, every test is called as test(peer, timeout)
+_HANDLERS = {
+    "tcp": lambda peer, timeout: _test_tcp(peer.host, peer.port_num, timeout),
+    "tls": lambda peer, timeout: _test_tls(peer.host, peer.port_num, timeout),
+    "ws": lambda peer, timeout: _test_websocket_async(peer.get_uri(), timeout),
+    "wss": lambda peer, timeout: _test_websocket_async(peer.get_uri(), timeout),
+    "quic": lambda peer, timeout: _test_quic_async(peer.host, peer.port_num, timeout),
+}
+
+
+async def _resolve(host: str, family: int) -> Optional[str]:
+    """Resolves a host name or address to a single address of the given family, or None."""
+    loop = asyncio.get_running_loop()
     try:
-        # Perform the asynchronous ping
-        result = await async_ping(host, count=3, timeout=timeout, family=6)
-        
-        if result.is_alive:
-            # Print the latency in milliseconds, formatted to two decimal places
-            log.debug(f"✅ SUCCESS: {peer.addr} -> {result.avg_rtt:.2f} ms")
-            peer.ping_latency = int(result.avg_rtt)
-            return peer
-        else:
-            raise Exception
-    except:
-        try:
-            result = await async_ping(host, count=3, timeout=timeout, family=4)
-            if result.is_alive:
-                # Print the latency in milliseconds, formatted to two decimal places
-                log.debug(f"✅ SUCCESS: {peer.addr} -> {result.avg_rtt:.2f} ms")
-                peer.ping_latency = int(result.avg_rtt)
-                return peer
-            else:
-                log.debug(f"❌ TIMEOUT: {peer.addr} -> No response within {timeout}s")
-                return peer
-        except Exception as e:
-            # Catches other errors like name resolution failures or permission errors
-            log.debug(f"🚫 ERROR:   {peer.addr} -> {e}")
-            return peer
+        infos = await loop.getaddrinfo(host, None, family=family, proto=socket.IPPROTO_TCP)
+        return infos[0][4][0]
+    except Exception as e:
+        log.debug(f"🚫 ERROR:   {host} -> {e}")
+        return None
 
-async def ping_peers(peers: List[Peer]) -> List[Peer]:
+async def ping_peers(peers: List[Peer], timeout: int = 10) -> List[Peer]:
     """
-    Takes a list of Peer objects and pings them all concurrently.
+    Takes a list of Peer objects and pings the alive ones in a single batch,
+    over IPv6 and IPv4 at once, keeping the lowest latency of each peer.
     """
     log.debug(f"--- Pinging {len(peers)} peers in parallel ---")
-    # Create a list of tasks, one for each peer if it have open ports
-    tasks = [_ping(peer) for peer in peers if peer.is_alive == True]
-    # Run all tasks concurrently and wait for them all to complete
-    updated_peers = await asyncio.gather(*tasks)
+    alive = [peer for peer in peers if peer.is_alive == True]
+    internet = []
+    for peer in alive:
+        if peer.network != 'internet':
+            peer.ping_latency = 60000 # in case of tor or i2p
+        else:
+            internet.append(peer)
+
+    pairs = [(peer, family) for peer in internet for family in (socket.AF_INET6, socket.AF_INET)]
+    addrs = await asyncio.gather(*(_resolve(peer.host, family) for peer, family in pairs))
+    targets = [(peer, addr) for (peer, _), addr in zip(pairs, addrs) if addr is not None]
+    replies = []
+    if targets:
+        try:
+            replies = await async_multiping([addr for _, addr in targets], count=3,
+                                            timeout=timeout, concurrent_tasks=128)
+        except Exception as e:
+            # Catches errors shared by the whole batch, like permission errors
+            log.debug(f"🚫 ERROR:   ping -> {e}")
+    for (peer, addr), reply in zip(targets, replies):
+        if not reply.is_alive:
+            continue
+        log.debug(f"✅ SUCCESS: {peer.addr} ({addr}) -> {reply.avg_rtt:.2f} ms")
+        rtt = int(reply.avg_rtt)
+        if peer.ping_latency == -1 or rtt < peer.ping_latency:
+            peer.ping_latency = rtt
+    for peer in internet:
+        if peer.ping_latency == -1:
+            log.debug(f"❌ TIMEOUT: {peer.addr} -> No response within {timeout}s")
     log.debug("--- All pings complete ---")
-    return updated_peers
+    return alive
 
 def _test_hidden_service(proxy: str, addr: str, network: str, port: int, timeout: int = 30) -> Tuple[bool, str]:
     """
@@ -122,8 +148,8 @@ def _test_hidden_service(proxy: str, addr: str, network: str, port: int, timeout
         bool type as the connection success, message for logging
     """
     # Tor's SOCKS5 proxy usually runs on localhost port 9050
-    proxy_host = proxy.split(':')[0]
-    proxy_port = int(proxy.split(':')[1])
+    proxy_host, _, proxy_port = proxy.rpartition(':')
+    proxy_port = int(proxy_port)
     
     full_address = addr + '.' + network
     
@@ -137,7 +163,7 @@ def _test_hidden_service(proxy: str, addr: str, network: str, port: int, timeout
         
         # Attempt to connect to the onion service
         # The DNS resolution is handled by the Tor proxy
-        s.connect((full_address, int(port)))
+        s.connect((full_address, port))
         #s.connect(('google.com', 80))
         return True, (f"✅ Success! Connection to {full_address}:{port} was successful.")
 
@@ -155,68 +181,67 @@ def _test_hidden_service(proxy: str, addr: str, network: str, port: int, timeout
         if 's' in locals():
             s.close()
 
-async def _test_endpoints(endpoints: List[Peer], timeout: int = 5) -> List[Peer]:
+async def _test_one(peer: Peer, sem: asyncio.Semaphore, loop: asyncio.AbstractEventLoop,
+                    timeout: int, progress: dict) -> Optional[Peer]:
     """
-    Parses and tests a list of endpoints in the format 'proto:ip:port'.
-
-    Args:
-        endpoints: A list of strings, e.g., ["tcp:google.com:80", "wss:echo.websocket.events:443"].
-        timeout: The connection timeout in seconds for each test.
+    Tests a single peer with the test matching its protocol.
+    At most `sem` peers are tested at the same time.
 
     Returns:
-        A list of tuples, where each tuple contains the original endpoint string,
-        a boolean indicating success, and a status message.
+        The peer with is_alive and latency set if the test succeeded, otherwise None.
     """
-    results = []
-    ping_cache = {}
-    latency = -2
-    loop = asyncio.get_running_loop()
-    import time
-    curr = 1
-    total = len(endpoints)
-    
-    for peer in endpoints:
-        print(f"\rtesting {curr}/{total}...", end='')
-        curr += 1
+    async with sem:
         start_time = time.perf_counter()
-        try:
-            proto, host, port = peer.proto, peer.addr, peer.port
-            if host[0] == '[': # unpack ipv6
-                host = host[1:-1]
-        except ValueError:
-            log.debug(peer.get_uri(), False, "Invalid format. Expected 'proto:ip:port'.")
-            continue
         
 #         TODO filter peer list
 #        if 'internet' == peer.network: continue
         
         if peer.network in ['onion', 'b32.i2p']:
-            success, message = _test_hidden_service(peer.proxy, host, peer.network, port)
-            log.debug(message)
-        elif proto == "tcp":
+            # blocking socks socket, keep it off the event loop
             success, message = await loop.run_in_executor(
-                None, _test_tcp_sync, host, port, timeout
+                None, _test_hidden_service, peer.proxy, peer.host, peer.network, peer.port_num
             )
-        elif proto == "tls":
-            success, message = await loop.run_in_executor(
-                None, _test_tls_sync, host, port, timeout
-            )
-        elif proto in ["ws", "wss"]:
-            uri = peer.get_uri()
-            success, message = await _test_websocket_async(uri, timeout)
-        elif proto == "quic":
-            success, message = await _test_quic_async(host, port, timeout)
+            log.debug(message)
         else:
-            success, message = False, f"Unsupported protocol: '{proto}'."
-        
-        if success: # results are only if some protocol works
-            end_time = time.perf_counter()
-            peer.is_alive = True
-            peer.latency = int((end_time - start_time) * 1000)
-            log.debug(f"latency: {peer.latency} ms")
-            assert peer != None, "peer is none"
-            results.append(peer)
-        log.debug(f"[{'✅ SUCCESS' if success else '❌ FAILURE'}] {message}")
+            test = _HANDLERS.get(peer.proto, _test_unsupported)
+            success, message = await test(peer, timeout)
+        end_time = time.perf_counter()
+
+    # single threaded event loop, no lock needed for the counter
+    progress['done'] += 1
+    print(f"\rtesting {progress['done']}/{progress['total']}...", end='')
+    log.debug(f"[{'✅ SUCCESS' if success else '❌ FAILURE'}] {message}")
+    if not success: # results are only if some protocol works
+        return None
+    peer.is_alive = True
+    peer.latency = int((end_time - start_time) * 1000)
+    log.debug(f"latency: {peer.latency} ms")
+    return peer
+
+async def _test_endpoints(endpoints: List[Peer], timeout: int = 5, concurrency: int = 64) -> List[Peer]:
+    """
+    Tests a list of peers concurrently and pings the ones that answered.
+
+    Args:
+        endpoints: A list of Peer objects to test.
+        timeout: The connection timeout in seconds for each test.
+        concurrency: The maximum number of peers tested at the same time.
+
+    Returns:
+        A list of the peers that answered, with latency and ping_latency set.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    progress = {'done': 0, 'total': len(endpoints)}
+    
+    tasks = [_test_one(peer, sem, loop, timeout, progress) for peer in endpoints]
+    tested = await asyncio.gather(*tasks, return_exceptions=True)
+    results = []
+    for peer, result in zip(endpoints, tested):
+        if isinstance(result, BaseException):
+            log.debug(f"🚫 ERROR:   {peer.get_uri()} -> {result}")
+        elif result is not None:
+            results.append(result)
     
     #ping from results only if peer is alive
     print()
@@ -226,13 +251,13 @@ async def _test_endpoints(endpoints: List[Peer], timeout: int = 5) -> List[Peer]
     return results
 
 async def main(options: str):
-    targets_to_test = get_peers()
+    targets_to_test = await get_peers()
 
     log.debug(f"--- Starting Connection Tests (Timeout={5}s) ---\n")
     results = await _test_endpoints(endpoints=targets_to_test, timeout=5)
     log.debug("\n--- All Tests Complete ---")
     
-    results = sorted(results, key=lambda peer: getattr(peer, "ping_latency"))
+    results.sort(key=attrgetter('ping_latency'))
     
     if options == 'key':
         for peer in results:
@@ -244,11 +269,7 @@ async def main(options: str):
             print(peer)
             print()
     else:
-        print_rows = []
-        for peer in results:
-            assert peer != None, "peer is none from ping"
-            print_rows.append(peer.get_row())
-        print(tabulate(print_rows, headers=['URI', 'Region', 'Country', 'Proto_latency', 'Ping_latency'], tablefmt="orgtbl"))
+        print(tabulate([peer.get_row() for peer in results], headers=['URI', 'Region', 'Country', 'Proto_latency', 'Ping_latency'], tablefmt="orgtbl"))
     return results
 
 